@@ -8,5 +8,8 @@ DOIT_CONFIG = {
 
 def task_build():
     return {
-        "actions": ["python -m nuitka src/tetripin/__main__.py  --standalone"],
+        "actions": [
+            "python -m nuitka src/tetripin/__main__.py  --standalone"
+            " --include-package=tetripin.commands"
+        ],
     }
@@ -0,0 +1,25 @@
+"""Decode a QR code image with the qrserver.com API
+
+Scratch script for the "read from qrcode local file" feature, not part of the
+package. Usage: python scripts/qr_probe.py image.png
+"""
+
+import os
+import sys
+
+import requests
+
+
+def main(path):
+    # max size : 1048576
+    with open(path, "rb") as f:
+        response = requests.post(
+            "http://api.qrserver.com/v1/read-qr-code/",
+            files={"file": f},
+            data={"MAX_FILE_SIZE": os.path.getsize(path)},
+        )
+    print(response.json())
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
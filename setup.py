@@ -1,38 +1,45 @@
 import re
 import sys
+from pathlib import Path
+
 import setuptools
 
+_SETUPPY_FORMAT = "https://github.com/{user}/{repo}/tarball/master#egg={egg}"
+_SETUPPY_RE = re.compile(
+    r"github.com/(?P<user>[^/.]+)/(?P<repo>[^.]+).git#egg=(?P<egg>.+)"
+)
+_PLATFORM_RE = re.compile(r"sys_platform\s*==\s*(.*)")
+_VERSION_RE = re.compile(rb"^__version__ = ['\"]([^'\"]*)['\"]", re.M)
+
 
 def get_version(path="src/tetripin/__init__.py"):
     """Return the version of by with regex intead of importing it"""
-    init_content = open(path, "rt").read()
-    pattern = r"^__version__ = ['\"]([^'\"]*)['\"]"
-    return re.search(pattern, init_content, re.M).group(1)
+    # The version is at the top of the file, no need to read all of it
+    with open(path, "rb") as f:
+        head = f.read(4096)
+    return _VERSION_RE.search(head).group(1).decode()
 
 
 def get_requirements(path):
-    setuppy_format = "https://github.com/{user}/{repo}/tarball/master#egg={egg}"
-
-    setuppy_pattern = r"github.com/(?P<user>[^/.]+)/(?P<repo>[^.]+).git#egg=(?P<egg>.+)"
+    current_platform = sys.platform
 
     dep_links = []
     install_requires = []
-    with open(path) as f:
-        for line in f:
-            if "sys_platform" in line:
-                line, platform = line.split(";")
+    for line in Path(path).read_text().splitlines():
+        if "sys_platform" in line:
+            line, platform = line.split(";")
 
-                match = re.search(r"sys_platform\s*==\s*(.*)", platform)
+            match = _PLATFORM_RE.search(platform)
 
-                if sys.platform != match.groups()[0].strip("\"'"):
-                    continue
+            if current_platform != match.groups()[0].strip("\"'"):
+                continue
 
-            if line.startswith("-e"):
-                url_infos = re.search(setuppy_pattern, line).groupdict()
-                dep_links.append(setuppy_format.format(**url_infos))
-                line = "==".join(url_infos["egg"].rsplit("-", 1))
+        if line.startswith("-e"):
+            url_infos = _SETUPPY_RE.search(line).groupdict()
+            dep_links.append(_SETUPPY_FORMAT.format(**url_infos))
+            line = "==".join(url_infos["egg"].rsplit("-", 1))
 
-            install_requires.append(line.strip())
+        install_requires.append(line.strip())
 
     return install_requires, dep_links
 
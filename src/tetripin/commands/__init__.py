@@ -0,0 +1 @@
+"""One module per CLI command, imported only when the command is run"""
@@ -0,0 +1,28 @@
+import click
+
+from tetripin.utils import atomic_write_toml
+
+
+@click.command()
+@click.argument("account")
+@click.argument("secret")
+@click.pass_context
+def add(ctx, account, secret):
+    """Add a new account"""
+    secrets_file = ctx.obj["secrets_file"]
+    # Already parsed by the cli group, and only used by this command
+    data = ctx.obj["data"]
+
+    # Accounts are looked up in lower case, so store them that way
+    account = account.strip().lower()
+    if account in data["account"]:
+        ctx.fail(f'An account named "{account}" already exists.')
+
+    if data["format_version"] == 1:
+        data["account"][account] = {"secret": secret}
+    else:
+        data["account"][account] = {"secret": ctx.obj["key"].encrypt_to_text(secret)}
+
+    atomic_write_toml(secrets_file, data)
+
+    click.echo("Account added")
@@ -0,0 +1,88 @@
+import textwrap
+import time
+from typing import Tuple, TypedDict
+
+import click
+from cryptography.fernet import InvalidToken
+
+from tetripin.exceptions import TetripinError
+from tetripin.utils import build_secret_map_from_toml
+
+try:
+    import orjson
+
+    def dumps(record) -> str:
+        return orjson.dumps(record, option=orjson.OPT_INDENT_2).decode("utf8")
+
+except ImportError:  # orjson is optional, it's only faster
+    import json
+
+    def dumps(record) -> str:
+        # Same output as orjson, which only supports 2 spaces indentation
+        return json.dumps(record, indent=2, ensure_ascii=False)
+
+
+class AndOTPExportFormat(TypedDict):
+    secret: str
+    label: str
+    last_used: int
+    tags: Tuple[str]
+    used_frequency: int
+    digits: int
+    period: int
+    algorithm: str
+    thumbnail: str
+    type: str
+    issuer: str
+
+
+@click.command()
+@click.option(
+    "--format",
+    help="App format to use. Only andotp is supported for now.",
+    default="andotp",
+)
+@click.pass_context
+def export(ctx, format="andotp"):
+    """Export the accounts to another app format"""
+
+    if format != "andotp":
+        ctx.fail("Only andotp is supported for now.")
+
+    try:
+        secrets_map = build_secret_map_from_toml(ctx.obj["key"], data=ctx.obj["data"])
+    except TetripinError as e:
+        ctx.fail(str(e))
+    except InvalidToken:
+        ctx.fail(
+            "Unable to decrypt the secrets with this key. Run 'tetripin unlock' again."
+        )
+
+    timestamp = time.time_ns() // 1_000_000
+
+    # Only the secret and the label change from one record to another
+    template = AndOTPExportFormat(
+        secret="",
+        label="",
+        last_used=timestamp,
+        tags=(),
+        used_frequency=0,
+        digits=6,
+        period=30,
+        algorithm="SHA1",
+        thumbnail="Default",
+        type="TOTP",
+        issuer="tetripin",
+    )
+
+    # Output the records one by one instead of serializing the whole list at
+    # once. The result is the same as json.dumps(list_of_records, indent=2).
+    click.echo("[", nl=False)
+    for i, (name, secret) in enumerate(secrets_map.items()):
+        record = template.copy()
+        record["secret"] = secret
+        record["label"] = name
+        separator = ",\n" if i else "\n"
+        entry = textwrap.indent(dumps(record), "  ")
+        click.echo(separator + entry, nl=False)
+    click.echo("\n]" if secrets_map else "]")
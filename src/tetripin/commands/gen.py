@@ -0,0 +1,40 @@
+import click
+from cryptography.fernet import InvalidToken
+
+from tetripin.exceptions import TetripinError
+from tetripin.utils import build_secret_map_from_toml, decode_totp_secret, totp_now
+
+
+@click.command()
+@click.argument("account")
+@click.pass_context
+def gen(ctx, account):
+    """Generate a PIN for the given account"""
+
+    # Open the secrets file
+    secrets_file = ctx.obj["secrets_file"]
+
+    try:
+        secrets_map = build_secret_map_from_toml(ctx.obj["key"], data=ctx.obj["data"])
+    except TetripinError as e:
+        ctx.fail(str(e))
+    except InvalidToken:
+        ctx.fail(
+            "Unable to decrypt the secrets with this key. Run 'tetripin unlock' again."
+        )
+
+    account = account.strip().lower()
+
+    if not secrets_map:
+        ctx.fail(f'No account listed in secrets file "{secrets_file}"')
+
+    if account not in secrets_map:
+        ctx.fail(f'No account named "{account}" in secrets file "{secrets_file}"')
+
+    # Generate and print the PIN
+    try:
+        seed = decode_totp_secret(secrets_map[account])
+    except ValueError:
+        ctx.fail(f"The secret for account '{account}' is not a valid TOTP token")
+
+    click.echo(totp_now(seed))
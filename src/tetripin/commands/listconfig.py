@@ -0,0 +1,9 @@
+import click
+
+
+@click.command()
+@click.pass_context
+def listconfig(ctx):
+    """Print informations about the program conf"""
+    for name, value in ctx.obj.items():
+        click.echo(f"{name}={value}")
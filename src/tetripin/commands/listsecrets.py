@@ -0,0 +1,21 @@
+import click
+from cryptography.fernet import InvalidToken
+
+from tetripin.exceptions import TetripinError
+from tetripin.utils import build_secret_map_from_toml
+
+
+@click.command()
+@click.pass_context
+def listsecrets(ctx):
+    """Print all the accounts and their secrets"""
+    try:
+        secrets_map = build_secret_map_from_toml(ctx.obj["key"], data=ctx.obj["data"])
+    except TetripinError as e:
+        ctx.fail(str(e))
+    except InvalidToken:
+        ctx.fail(
+            "Unable to decrypt the secrets with this key. Run 'tetripin unlock' again."
+        )
+    for name, value in secrets_map.items():
+        click.echo(f"{name}={value}")
@@ -0,0 +1,34 @@
+import os
+
+import click
+import keyring
+from keyring.errors import PasswordDeleteError
+
+from tetripin.utils import get_key_from_keyring
+
+
+@click.command()
+@click.pass_context
+def lock(ctx):
+    """Remove the password from the OS keyring"""
+
+    if click.confirm(
+        "Lock the codes? Make sure you have access to the password. They cannot be recovered without it.",
+        abort=True,
+    ):
+        try:
+            keyring.delete_password("tetripin", "key")
+        except PasswordDeleteError:
+            ctx.fail("You codes are already locked.")
+        get_key_from_keyring.cache_clear()
+        if os.environ.get("TETRIPIN_KEY"):
+            click.echo(
+                "The keyring is locked, but TETRIPIN_KEY is set and still unlocks "
+                "your codes. Unset it to lock them.",
+                err=True,
+            )
+        else:
+            click.echo("Locking successful")
+    else:
+        # Handle the case where the user does not confirm
+        click.echo("Locking aborded.")
@@ -0,0 +1,60 @@
+import time
+
+import click
+from cryptography.fernet import InvalidToken
+
+from tetripin.exceptions import TetripinError
+from tetripin.utils import (
+    build_secret_map_from_toml,
+    calculate_totp_codes,
+    decode_totp_secret,
+    load_secrets_from_toml,
+    parse_secrets_file,
+)
+
+
+def _measure(func, iterations):
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        func()
+    return time.perf_counter_ns() - start
+
+
+@click.command(hidden=True)
+@click.option(
+    "--iterations", "-n", default=1000, show_default=True, type=click.IntRange(min=1)
+)
+@click.pass_context
+def profile(ctx, iterations):
+    """Time the hot paths of the CLI and the TUI, for development only"""
+
+    secrets_file = ctx.obj["secrets_file"]
+    key = ctx.obj["key"]
+
+    try:
+        secrets_map = build_secret_map_from_toml(key, data=ctx.obj["data"])
+        seeds = {name: decode_totp_secret(s) for name, s in secrets_map.items()}
+    except (TetripinError, ValueError) as e:
+        ctx.fail(str(e))
+    except InvalidToken:
+        ctx.fail(
+            "Unable to decrypt the secrets with this key. Run 'tetripin unlock' again."
+        )
+
+    hot_paths = {
+        "parse secrets file": lambda: parse_secrets_file(secrets_file),
+        "load secrets (cached)": lambda: load_secrets_from_toml(secrets_file),
+        "decrypt secrets": lambda: build_secret_map_from_toml(
+            key, data=ctx.obj["data"]
+        ),
+        "decode seeds": lambda: [decode_totp_secret(s) for s in secrets_map.values()],
+        "calculate codes": lambda: calculate_totp_codes(seeds),
+    }
+
+    click.echo(f"{len(secrets_map)} account(s), {iterations} iterations")
+    for name, func in hot_paths.items():
+        total = _measure(func, iterations)
+        click.echo(
+            f"{name:<25} {total / 1_000_000:10.2f} ms"
+            f" {total / iterations / 1000:10.2f} µs/call"
+        )
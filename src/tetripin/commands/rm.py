@@ -0,0 +1,24 @@
+import click
+
+from tetripin.utils import atomic_write_toml
+
+
+@click.command()
+@click.argument("account")
+@click.pass_context
+def rm(ctx, account):
+    """Remove an account"""
+    secrets_file = ctx.obj["secrets_file"]
+    # Already parsed by the cli group, and only used by this command
+    data = ctx.obj["data"]
+
+    # Labels are stored in lower case, see load_secrets_from_toml()
+    account = account.strip().lower()
+    if account not in data["account"]:
+        ctx.fail(f'No account named "{account}".')
+
+    res = data["account"].pop(account)
+
+    atomic_write_toml(secrets_file, data)
+
+    click.echo(f"Account removed: {account}={res['secret']}")
@@ -0,0 +1,13 @@
+import click
+
+
+@click.command()
+@click.pass_context
+def tui(ctx):
+    """Display the codes in a terminal UI"""
+    # textual is slow to import, and needed only when the command is run, not
+    # when the help is displayed
+    from tetripin.tui import TOTPApp
+
+    app = TOTPApp(ctx.obj["key"], ctx.obj["secrets_file"])
+    app.app.run()
@@ -0,0 +1,41 @@
+import getpass
+
+import click
+import keyring
+from cryptography.fernet import InvalidToken
+
+from tetripin.exceptions import TetripinError
+from tetripin.utils import (
+    EncryptionKey,
+    build_secret_map_from_toml,
+    check_format_version,
+    get_key_from_keyring,
+    load_secrets_from_toml,
+)
+
+
+@click.command()
+@click.pass_context
+def unlock(ctx):
+    """Save the password to decrypt the codes in the OS keyring"""
+    secrets_file = ctx.obj["secrets_file"]
+
+    try:
+        data = load_secrets_from_toml(secrets_file)
+        check_format_version(data)
+    except TetripinError as e:
+        ctx.fail(str(e))
+
+    password = getpass.getpass("Enter your password: ")
+    key = EncryptionKey.from_password(password, data["salt"])
+
+    try:
+        build_secret_map_from_toml(key, data=data)
+    except TetripinError as e:
+        ctx.fail(str(e))
+    except InvalidToken:
+        ctx.fail("This password is incorrect")
+
+    keyring.set_password("tetripin", "key", str(key))
+    get_key_from_keyring.cache_clear()
+    click.echo("Your codes are now unlocked.")
@@ -0,0 +1,76 @@
+import base64
+import secrets
+import shutil
+
+import click
+from cryptography.fernet import InvalidToken
+import keyring
+
+from tetripin.exceptions import TetripinError
+from tetripin.utils import (
+    EncryptionKey,
+    atomic_write_toml,
+    build_secret_map_from_toml,
+    get_key_from_keyring,
+    load_secrets_from_toml,
+    prompt_password,
+)
+
+
+@click.command()
+@click.pass_context
+def upgrade_config(ctx):
+    """Upgrade the format of the config file"""
+    secrets_file = ctx.obj["secrets_file"]
+
+    try:
+        old_data = load_secrets_from_toml(secrets_file)
+    except TetripinError as e:
+        ctx.fail(str(e))
+
+    if old_data["format_version"] == 3:
+        click.echo("You are already at the last version, nothing to do")
+
+    click.echo(
+        "This is going to convert your old config file to the new encrypted format."
+    )
+
+    backup_file = f'{ctx.obj["secrets_file"]}.bak'
+    shutil.copyfile(ctx.obj["secrets_file"], backup_file)
+    click.echo(f"A backup has been created: {backup_file}")
+
+    try:
+        old_key = get_key_from_keyring()
+    except TetripinError as e:
+        ctx.fail(str(e))
+
+    salt = base64.b64encode(secrets.token_bytes(16)).decode("utf-8")
+    data = {
+        "format_version": 3,
+        "account": {},
+        "salt": salt,
+    }
+    try:
+        secrets_map = build_secret_map_from_toml(old_key, data=old_data)
+    except TetripinError as e:
+        ctx.fail(str(e))
+    except InvalidToken:
+        ctx.fail(
+            "Unable to decrypt the secrets with this key. Run 'tetripin unlock' again."
+        )
+
+    password = prompt_password("Please chose a password to protect your codes.")
+    new_key = EncryptionKey.from_password(password, salt)
+
+    for account, secret in secrets_map.items():
+        data["account"][account] = {"secret": new_key.encrypt_to_text(secret)}
+
+    atomic_write_toml(secrets_file, data)
+
+    keyring.set_password("tetripin", "key", str(new_key))
+    get_key_from_keyring.cache_clear()
+
+    click.echo("Your secrets are now secured with your password.")
+    click.echo(
+        f"Check that everything works, then delete the backup file: {backup_file}"
+    )
@@ -1,25 +1,23 @@
 from math import floor
-from time import monotonic
+from time import time
 from textual.reactive import reactive
-import pyotp
 from textual import on
 from textual.app import App, ComposeResult
 from textual.containers import ScrollableContainer
 from textual.widgets import Footer, Static, Input, Label, ProgressBar
 from textual.widget import Widget
-import clipman
+from cryptography.fernet import InvalidToken
 from tetripin.exceptions import TetripinError
 from tetripin.utils import (
     DATA_DIR,
     build_secret_map_from_toml,
+    calculate_totp_codes,
+    decode_totp_secret,
     get_key_from_keyring,
     ensure_secrets_file,
 )
 
 
-clipman.init()
-
-
 class Header(Widget):
     remaining_time = reactive(30)
 
@@ -58,20 +56,55 @@ class CodeLine(Static):
         yield Label(self.account, id="account")
         yield Label(self.code, id="code")
 
+    def update_code(self, code):
+        self.code = code
+        self.query_one("#code", Label).update(code)
+
     async def on_click(self, event) -> None:
-        clipman.set(self.code)
+        # clipman fails to initialize without a graphical session, so we only
+        # do it when the user actually wants to copy a code
+        import clipman
+        from clipman.exceptions import ClipmanBaseException
+
+        try:
+            clipman.init()
+            clipman.set(self.code)
+        except ClipmanBaseException as e:
+            self.notify(
+                f"Unable to copy to clipboard: {e}", severity="error", timeout=5
+            )
+            return
         self.notify("Copied to clipboard", severity="info", timeout=2)
 
 
 class Body(Widget):
-    codes = reactive({}, recompose=True)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.codes = {}
+        self.code_lines = {}
 
     def compose(self):
-        code_lines = [
-            CodeLine(account, code, classes=("even" if i % 2 == 0 else "odd"))
-            for i, (account, code) in enumerate(self.codes.items())
-        ]
-        yield ScrollableContainer(*code_lines, id="codes")
+        yield ScrollableContainer(id="codes")
+
+    def update_codes(self, codes):
+        """Display the codes, only rebuilding the lines if the accounts changed"""
+        if list(codes) == list(self.codes):
+            # Most refreshes just get new codes for the same accounts
+            for account, code in codes.items():
+                if code != self.codes[account]:
+                    self.code_lines[account].update_code(code)
+        else:
+            self.code_lines = {
+                account: CodeLine(
+                    account, code, classes=("even" if i % 2 == 0 else "odd")
+                )
+                for i, (account, code) in enumerate(codes.items())
+            }
+            container = self.query_one("#codes", ScrollableContainer)
+            container.remove_children()
+            container.mount_all(self.code_lines.values())
+
+        self.codes = codes
 
 
 class TOTPApp(App):
@@ -81,63 +114,113 @@ class TOTPApp(App):
     remaining_time = reactive(30)
 
     def __init__(self, key=None, secrets_file=None, data_dir=DATA_DIR):
-        key = key or get_key_from_keyring()
-        if not key:
+        # notify() needs the app to be initialized
+        super().__init__()
+
+        self.secrets_map = {}
+        try:
+            key = key or get_key_from_keyring()
+            if not key:
+                raise TetripinError(
+                    "Your codes are locked, run 'tetripin unlock' first"
+                )
+            secrets_file = secrets_file or ensure_secrets_file(data_dir, secrets_file)
+            self.secrets_map = build_secret_map_from_toml(key, secrets_file)
+        except TetripinError as e:
+            self.notify(str(e), severity="error", timeout=10)
+        except InvalidToken:
             self.notify(
-                "Your codes are locked, run 'tetripin unlock' first",
+                "Unable to decrypt the secrets with this key. Run 'tetripin unlock' again.",
                 severity="error",
                 timeout=10,
             )
-            self.secrets_map = {}
-        else:
+
+        # Decoding the seeds is done once, not at every refresh
+        self.seeds = {}
+        for account, secret in self.secrets_map.items():
             try:
-                secrets_file = secrets_file or ensure_secrets_file(
-                    data_dir, secrets_file
+                self.seeds[account] = decode_totp_secret(secret)
+            except ValueError:
+                self.notify(
+                    f"The secret for account '{account}' is not a valid TOTP token",
+                    severity="error",
+                    timeout=10,
                 )
-                self.secrets_map = build_secret_map_from_toml(key, secrets_file)
-            except TetripinError as e:
-                self.secrets_map = {}
-                self.notify(str(e), severity="error", timeout=10)
-
         self.interval = 30  # TOTP default time interval
 
-        super().__init__()
+        # Filtering state, to only search the accounts matching the previous
+        # filter when the user keeps typing
+        self.account_filter = ""
+        self._accounts_sorted = sorted(self.seeds)
+        self._last_filter = ""
+        self._last_matches = self._accounts_sorted
+        self._filter_timer = None
+
+        # Interval the displayed codes belong to, and the timer refreshing them
+        self._code_period = None
+        self._code_timer = None
 
     def on_mount(self) -> None:
-        self.update_code_lines()
+        self.refresh_codes()
         self.set_interval(1, self.update_timer)
-        self.title = f"{self.remaining_time}s"
         self.update_timer()
 
-    def calculate_codes(self, secrets, account_filter):
-        secrets = sorted(secrets.items(), key=lambda e: e[0])
-        filtered_secrets = [
-            (account, seed)
-            for account, seed in secrets
-            if not account_filter or account_filter in account
-        ]
-        return {
-            account: str(pyotp.TOTP(seed).now()) for account, seed in filtered_secrets
+    def refresh_codes(self):
+        # The codes only change at the end of each interval, so the next refresh
+        # is scheduled at the next interval boundary. Textual timers use a
+        # monotonic clock, so they are re-armed from the wall clock every time.
+        self._code_period = int(time()) // self.interval
+        self.update_code_lines()
+        if self._code_timer:
+            self._code_timer.stop()
+        self._code_timer = self.set_timer(
+            self.interval - (time() % self.interval), self.refresh_codes
+        )
+
+    def filter_accounts(self, account_filter):
+        """Return the sorted accounts containing account_filter"""
+        # Accounts are stored in lower case, and "" is in every account name
+        account_filter = account_filter.lower()
+        if account_filter.startswith(self._last_filter):
+            # A longer filter can only match a subset of the previous matches
+            candidates = self._last_matches
+        else:
+            candidates = self._accounts_sorted
+
+        matches = [account for account in candidates if account_filter in account]
+        self._last_filter, self._last_matches = account_filter, matches
+        return matches
+
+    def calculate_codes(self, seeds, account_filter):
+        filtered_seeds = {
+            account: seeds[account] for account in self.filter_accounts(account_filter)
         }
+        return calculate_totp_codes(filtered_seeds, interval=self.interval)
 
     def calculate_remaining_time(self):
-        return floor(self.interval - (monotonic() % self.interval))
+        return floor(self.interval - (time() % self.interval))
 
-    def update_code_lines(self, account_filter=""):
-        self.query_one(Body).codes = self.calculate_codes(
-            self.secrets_map, account_filter
-        )
+    def update_code_lines(self):
+        body = self.query_one(Body)
+        codes = self.calculate_codes(self.seeds, self.account_filter)
+        if codes != body.codes:
+            body.update_codes(codes)
 
     def update_timer(self):
         # Calculate the remaining time for the current TOTP code
         self.remaining_time = self.calculate_remaining_time()
         self.title = f"{self.remaining_time}s"
-        if self.remaining_time == 0:
-            self.update_code_lines()
+        # Catch up if the clock jumped (suspend, time change) past a boundary
+        if int(time()) // self.interval != self._code_period:
+            self.refresh_codes()
 
     @on(Input.Changed)
     def update_code_list_widget(self, event: Input.Changed) -> None:
-        self.query_one(Body).codes = self.calculate_codes(self.secrets_map, event.value)
+        # Wait for the user to stop typing before refreshing the list
+        self.account_filter = event.value
+        if self._filter_timer:
+            self._filter_timer.stop()
+        self._filter_timer = self.set_timer(0.1, self.update_code_lines)
 
     def compose(self) -> ComposeResult:
         yield Header(interval=self.interval).data_bind(TOTPApp.remaining_time)
@@ -1,41 +1,71 @@
+import copy
+import functools
 import getpass
+import hashlib
+import hmac
+import json
+import os
 import re
 
 import secrets
-from typing import Union
-import keyring
+import stat
+import struct
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Union
 from path import Path
-import toml
-from cryptography.fernet import Fernet
 
 from tetripin.exceptions import TetripinError
 from appdirs import user_data_dir
 import logging
 import base64
+import binascii
 
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
 
-from cryptography.fernet import Fernet
 from typing_extensions import Self
 
-from cryptography.hazmat.primitives import hashes
-
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+# keyring, cryptography and tomli_w are imported in the functions using them,
+# so that commands such as "listconfig" don't pay for their import time
 
 log = logging.getLogger(__name__)
 
 DATA_DIR = user_data_dir("tetripin", "tetricoins", version="0.1")
 
+# Parsed secrets files for this process: abspath -> (cache key, data)
+_TOML_CACHE: "OrderedDict[str, Tuple[bytes, Dict]]" = OrderedDict()
+_TOML_CACHE_MAX_SIZE = 100
+# Bump it when the cached data changes shape, or to rewrite the old cache files
+_SECRETS_CACHE_VERSION = 5
+
+# Keys derived by this process: (sha256(password), salt) -> key. The password
+# is hashed so that it's not kept in memory in clear text.
+_DERIVED_KEYS_CACHE: "OrderedDict[Tuple[bytes, str], bytes]" = OrderedDict()
+_DERIVED_KEYS_CACHE_MAX_SIZE = 4
+
+# tomllib doesn't expose the duplicated key in the exception, only in the message
+DUPLICATE_KEY_RE = re.compile(r"Cannot declare \(.*'([^']+)'\) twice")
+
 
 class EncryptionKey:
     """Convenience wrapper on top of Fernet primitives"""
 
     def __init__(self, value):
+        from cryptography.fernet import Fernet
+
         self.bytes = value
         self.fernet = Fernet(value)
 
     @classmethod
     def from_string(cls, value) -> Self:
-        return cls(cls._from_utf8(value))
+        """Load a key serialized with str(), e.g: from the keyring
+
+        No derivation happens, unlike with from_password().
+        """
+        return cls(cls._to_utf8(value))
 
     @classmethod
     def from_password(cls, password: str, salt: str) -> Self:
@@ -44,13 +74,28 @@ class EncryptionKey:
         Password must be the value as typed as the user, salt must be
         a base64 encoded number
         """
+        # PBKDF2 is slow on purpose, don't run it twice for the same input
+        password_bytes = cls._to_utf8(password)
+        cache_key = (hashlib.sha256(password_bytes).digest(), salt)
+        value = _DERIVED_KEYS_CACHE.get(cache_key)
+        if value is not None:
+            _DERIVED_KEYS_CACHE.move_to_end(cache_key)
+            return cls(value)
+
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
         kdf = PBKDF2HMAC(
             algorithm=hashes.SHA256(),
             length=32,
             salt=base64.b64decode(salt),
             iterations=480000,
         )
-        value = base64.urlsafe_b64encode(kdf.derive(cls._to_utf8(password)))
+        value = base64.urlsafe_b64encode(kdf.derive(password_bytes))
+
+        _DERIVED_KEYS_CACHE[cache_key] = value
+        if len(_DERIVED_KEYS_CACHE) > _DERIVED_KEYS_CACHE_MAX_SIZE:
+            _DERIVED_KEYS_CACHE.popitem(last=False)
 
         return cls(value)
 
@@ -71,6 +116,45 @@ class EncryptionKey:
     def decrypt_from_text(self, text) -> str:
         return self._from_utf8(self.fernet.decrypt(self._to_utf8(text)))
 
+    def decrypt_many(self, tokens: List[str]) -> List[str]:
+        """Decrypt several Fernet tokens, sharing the crypto setup between them
+
+        Same checks and errors as Fernet.decrypt() (without TTL), but the HMAC
+        and the AES algorithm are created once instead of once per token.
+        """
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.fernet import InvalidToken
+        from cryptography.hazmat.primitives import hashes, padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+        from cryptography.hazmat.primitives.hmac import HMAC
+
+        key = base64.urlsafe_b64decode(self.bytes)
+        signature = HMAC(key[:16], hashes.SHA256())
+        aes = algorithms.AES(key[16:])
+
+        decrypted = []
+        for token in tokens:
+            try:
+                # version (1) | timestamp (8) | IV (16) | ciphertext | HMAC (32)
+                data = base64.urlsafe_b64decode(self._to_utf8(token))
+                if len(data) < 57 or data[0] != 0x80:
+                    raise InvalidToken
+
+                h = signature.copy()
+                h.update(data[:-32])
+                h.verify(data[-32:])
+
+                decryptor = Cipher(aes, modes.CBC(data[9:25])).decryptor()
+                padded = decryptor.update(data[25:-32]) + decryptor.finalize()
+                unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+                plaintext = unpadder.update(padded) + unpadder.finalize()
+            except (TypeError, ValueError, binascii.Error, InvalidSignature):
+                raise InvalidToken
+
+            decrypted.append(self._from_utf8(plaintext))
+
+        return decrypted
+
 
 def prompt_password(prompt: str) -> str:
     print(prompt)
@@ -87,14 +171,43 @@ def prompt_password(prompt: str) -> str:
     return password1
 
 
+def _get_raw_key() -> Union[str, None]:
+    import keyring
+
+    return keyring.get_password("tetripin", "key")
+
+
+# Keyring access is slow, so the key is read only once per process. Clear the
+# cache after changing the keyring content.
+@functools.lru_cache(maxsize=1)
 def get_key_from_keyring() -> Union[EncryptionKey, None]:
-    key = keyring.get_password("tetripin", "key")
+    # The keyring stores the derived key, not the password, so no KDF is needed.
+    # TETRIPIN_KEY can hold the same value, to skip the OS keyring entirely.
+    env_key = os.environ.get("TETRIPIN_KEY")
+    if env_key:
+        try:
+            return EncryptionKey.from_string(env_key)
+        except ValueError:
+            raise TetripinError(
+                "TETRIPIN_KEY doesn't contain a valid key. Set it to the key "
+                "stored in the keyring, or unset it."
+            )
 
+    key = _get_raw_key()
     if key:
-        return EncryptionKey(key)
+        return EncryptionKey.from_string(key)
 
 
 def ensure_secrets_file(data_dir=None, secrets_file=None):
+    # Fast path: the secrets file from the settings dir almost always exists
+    if data_dir and not secrets_file:
+        default_secrets_file = Path(data_dir) / "secrets.toml"
+        try:
+            if stat.S_ISREG(os.stat(default_secrets_file).st_mode):
+                return default_secrets_file
+        except OSError:
+            pass
+
     # Try to get a setting dir
     if data_dir:
         data_dir = Path(data_dir)
@@ -118,18 +231,15 @@ def ensure_secrets_file(data_dir=None, secrets_file=None):
             try:
                 # generate an empty file
                 if not secrets_file.isfile():
-                    with secrets_file.open("a", encoding="utf8") as f:
-                        toml.dump(
-                            {
-                                "format_version": 2,
-                                "account": {},
-                                "salt": secrets.token_bytes(16),
-                            },
-                            f,
-                        )
-                else:  # update the access time
-                    with secrets_file.open("a", encoding="utf8") as f:
-                        secrets_file.utime(None)
+                    salt = secrets.token_bytes(16)
+                    atomic_write_toml(
+                        secrets_file,
+                        {
+                            "format_version": 2,
+                            "account": {},
+                            "salt": base64.b64encode(salt).decode("utf-8"),
+                        },
+                    )
             except (OSError, IOError) as ex:
                 raise TetripinError(
                     f'Unable to open the secrets file "{secrets_file}": {ex}'
@@ -142,37 +252,140 @@ def ensure_secrets_file(data_dir=None, secrets_file=None):
     return secrets_file
 
 
-def load_secrets_from_toml(secrets_file):
+def _atomic_write_bytes(path, payload: bytes, mode: int, fsync=True):
+    """Write payload to a temp file created with mode, then move it over path
+
+    The temp file gets the permissions from creation (restricted by the umask), so
+    its content is never more exposed than the final file. It's removed on failure.
+    """
+    tmp_file = f"{path}.tmp"
+    # A left over temp file would keep its own permissions
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    payload = memoryview(payload)
     try:
-        with open(secrets_file, encoding="utf8") as f:
-            data = toml.load(f)
-    except (OSError, IOError) as ex:
-        raise TetripinError(f'Unable to open the secrets file "{secrets_file}": {ex}')
+        # O_BINARY only exists, and is needed, on Windows
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+        fd = os.open(tmp_file, flags, mode)
+        try:
+            # A single syscall for files this small
+            while payload:
+                payload = payload[os.write(fd, payload) :]
+            if fsync:
+                # Make sure the content is on disk before the rename makes it visible
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def atomic_write_toml(secrets_file, data):
+    """Write data as TOML to a temp file, then move it over the secrets file
+
+    The secrets file is never left half written, and it keeps its permissions.
+    """
+    import tomli_w
 
-    # Handle bad TOML
-    except toml.TomlDecodeError as ex:
-        msg = f"'{secrets_file}' is not a valid TOML file (Error given is: {ex})\n"
-        error = ex.args[0]
-        if error == "Invalid date or number":
-            msg += (
-                "One frequent cause of this is forgetting to put quotes "
-                "around secret keys. Check the file."
-            )
-        # TODO: ask the toml guy to put a better error catching system in place
-        match = re.search(r"What\? (\w+) ", error)
-        duplicate = match and next(iter(match.groups()), None)
-        if duplicate:
-            msg += (
-                "One frequent cause of this is using the same account name "
-                f"twice. Check that you didn't use '{duplicate}' several times."
-            )
+    try:
+        mode = stat.S_IMODE(os.stat(secrets_file).st_mode)
+    except FileNotFoundError:
+        mode = 0o666
 
-        raise TetripinError(msg)
+    # Serializing first means an encoding error leaves nothing behind
+    payload = tomli_w.dumps(data).encode("utf8")
+    _atomic_write_bytes(secrets_file, payload, mode)
 
-    except UnicodeDecodeError:
-        raise TetripinError(
-            f'Unable to open the secrets file "{secrets_file}": it must be UTF8'
+    clear_secrets_cache(secrets_file)
+
+
+def get_secrets_cache_file(secrets_file) -> Path:
+    return Path(f"{secrets_file}.cache")
+
+
+def clear_secrets_cache(secrets_file):
+    """Remove the parsed secrets cache. Call it whenever the TOML file is written"""
+    _TOML_CACHE.pop(os.path.abspath(secrets_file), None)
+    try:
+        os.remove(get_secrets_cache_file(secrets_file))
+    except FileNotFoundError:
+        pass
+
+
+def _read_secrets_cache(secrets_file, cache_key: bytes):
+    """Return the cached parsed TOML if it matches the cache key, None otherwise
+
+    The cache is JSON, not pickle, so a planted cache file can't run code. We
+    also ignore it if somebody else could have written it.
+    """
+    try:
+        with open(get_secrets_cache_file(secrets_file), "rb") as f:
+            cache_stat = os.fstat(f.fileno())
+            if cache_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                return None
+            if hasattr(os, "getuid") and cache_stat.st_uid != os.getuid():
+                return None
+            if f.read(len(cache_key)) != cache_key:
+                return None
+            return json.loads(f.read())
+    except Exception:
+        # The cache is just an optimization, any problem means we parse again
+        return None
+
+
+def _write_secrets_cache(secrets_file, cache_key: bytes, data, mode: int):
+    """Save the parsed TOML next to the secrets file, with the same permissions
+
+    Only encrypted secrets are cached: old formats contain the seeds in clear
+    text, and we don't want to spread them in another file.
+    """
+    cache_file = get_secrets_cache_file(secrets_file)
+    try:
+        if data.get("format_version") != 3:
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+            return
+
+        # Raise TypeError for TOML values JSON doesn't have, such as dates
+        payload = json.dumps(data, ensure_ascii=False).encode("utf8")
+
+        # Losing the cache in a crash is harmless, no need to fsync it
+        _atomic_write_bytes(cache_file, cache_key + payload, mode, fsync=False)
+    except (OSError, TypeError) as ex:
+        log.info(f'Unable to write the secrets cache "{cache_file}": {ex}')
+
+
+def load_secrets_from_toml(secrets_file):
+    try:
+        # The cache is keyed with a 18 bytes header: cache version + mtime (ns) + size
+        file_stat = os.stat(secrets_file)
+        cache_key = struct.pack(
+            "<Hqq", _SECRETS_CACHE_VERSION, file_stat.st_mtime_ns, file_stat.st_size
         )
+    except (OSError, IOError) as ex:
+        raise TetripinError(f'Unable to open the secrets file "{secrets_file}": {ex}')
+
+    # Callers may modify the data before writing it back, hence the deep copies
+    path = os.path.abspath(secrets_file)
+    cached = _TOML_CACHE.get(path)
+    if cached and cached[0] == cache_key:
+        _TOML_CACHE.move_to_end(path)
+        data = copy.deepcopy(cached[1])
+    else:
+        data = _read_secrets_cache(secrets_file, cache_key)
+        if data is None:
+            data = _normalize_accounts(secrets_file, parse_secrets_file(secrets_file))
+            mode = stat.S_IMODE(file_stat.st_mode)
+            _write_secrets_cache(secrets_file, cache_key, data, mode)
+
+        _TOML_CACHE[path] = (cache_key, copy.deepcopy(data))
+        _TOML_CACHE.move_to_end(path)
+        if len(_TOML_CACHE) > _TOML_CACHE_MAX_SIZE:
+            _TOML_CACHE.popitem(last=False)
 
     if "format_version" not in data:
         raise TetripinError(
@@ -187,20 +400,152 @@ def load_secrets_from_toml(secrets_file):
     return data
 
 
-def build_secret_map_from_toml(key: Union[EncryptionKey, None], secrets_file):
+def check_format_version(data):
+    # if we use the old clear text format, ask to convert it to the encrypted format
+    if data["format_version"] != 3:
+        raise TetripinError(
+            "You have an old unsecured config file. Run 'tetripin upgrade-config' to secure it."
+        )
+
+
+def _normalize_accounts(secrets_file, data):
+    """Store the account labels in lower case, without surrounding spaces
+
+    'add' writes them that way, but older versions did not. Doing it once after
+    parsing means the result is cached, and reading the labels costs nothing.
+    The normalized labels are written back by the next command changing the file,
+    so labels that can't be normalized without losing an account are an error.
+    """
+    accounts = data.get("account")
+    if isinstance(accounts, dict):
+        normalized = {}
+        for label, infos in accounts.items():
+            name = label.lower().strip()
+            if not name:
+                raise TetripinError(
+                    "An account has an empty name in the secrets file "
+                    f'"{secrets_file}". Give it a name or remove it.'
+                )
+            if name in normalized:
+                raise TetripinError(
+                    f'Several accounts are named "{name}" in the secrets file '
+                    f'"{secrets_file}". Names are not case sensitive, rename or '
+                    "remove all of them but one."
+                )
+            normalized[name] = infos
+        data["account"] = normalized
+    return data
+
+
+def parse_secrets_file(secrets_file):
+    """Parse the TOML secrets file, without any cache. Use load_secrets_from_toml()"""
+    try:
+        # Read the whole file at once and decode it a single time
+        return tomllib.loads(Path(secrets_file).read_bytes().decode("utf-8"))
+    except (OSError, IOError) as ex:
+        raise TetripinError(f'Unable to open the secrets file "{secrets_file}": {ex}')
+    except tomllib.TOMLDecodeError as ex:
+        raise TetripinError(_explain_toml_error(secrets_file, ex))
+    except UnicodeDecodeError:
+        raise TetripinError(
+            f'Unable to open the secrets file "{secrets_file}": it must be UTF8'
+        )
+
+
+def _explain_toml_error(secrets_file, ex: tomllib.TOMLDecodeError) -> str:
+    """Build an error message with hints about the usual causes of bad TOML"""
+    msg = f"'{secrets_file}' is not a valid TOML file (Error given is: {ex})\n"
+    error = ex.args[0]
+    if error.startswith("Invalid value"):
+        msg += (
+            "One frequent cause of this is forgetting to put quotes "
+            "around secret keys. Check the file."
+        )
+    match = DUPLICATE_KEY_RE.search(error)
+    duplicate = match and next(iter(match.groups()), None)
+    if duplicate:
+        msg += (
+            "One frequent cause of this is using the same account name "
+            f"twice. Check that you didn't use '{duplicate}' several times."
+        )
+    elif error.startswith(
+        (
+            # Repeated "name = {...}" or dotted keys
+            "Cannot overwrite a value",
+            # Repeated names inside an inline table
+            "Cannot mutate immutable namespace",
+            "Duplicate inline table key",
+        )
+    ):
+        # tomllib doesn't always give the name, so the hint stays generic
+        msg += (
+            "One frequent cause of this is using the same account name "
+            "twice, or giving an account several secrets. Check the file."
+        )
+
+    return msg
+
+
+def build_secret_map_from_toml(
+    key: Union[EncryptionKey, None], secrets_file=None, *, data=None
+):
+    """Return a map of account -> decrypted secret
+
+    Pass the already loaded TOML content as data to avoid parsing the
+    secrets file again.
+    """
     secrets_map = {}
-    data = load_secrets_from_toml(secrets_file)
+    if data is None:
+        data = load_secrets_from_toml(secrets_file)
 
+    # Labels are already normalized by load_secrets_from_toml()
     for label, infos in data["account"].items():
-        label = label.lower().strip()
-        if label:
-            secret = infos.get("secret", "").strip()
-            if not secret:
-                raise TetripinError(f"Account '{label}' don't have a secret.")
+        secret = infos.get("secret", "").strip()
+        if not secret:
+            raise TetripinError(f"Account '{label}' don't have a secret.")
 
-            if key:
-                secret = key.decrypt_from_text(secret)
+        secrets_map[label] = secret
 
-            secrets_map[label] = secret
+    if key:
+        decrypted = key.decrypt_many(list(secrets_map.values()))
+        secrets_map = dict(zip(secrets_map, decrypted))
 
     return secrets_map
+
+
+def decode_totp_secret(secret: str) -> bytes:
+    """Decode a base32 TOTP secret, adding the padding it usually lacks
+
+    Raise ValueError if the secret is not valid base32 (binascii.Error, a subclass,
+    for most invalid secrets, but a plain ValueError for non ASCII ones).
+    """
+    return base64.b32decode(secret + "=" * (-len(secret) % 8), casefold=True)
+
+
+def totp_now(raw_seed: bytes, t=None, interval=30) -> str:
+    """Return the 6 digits TOTP code (SHA1) for a decoded seed at time t (now by default)
+
+    This is RFC 4226 HOTP, with RFC 6238 time based counter, computed with a single
+    HMAC.
+    """
+    t = time.time() if t is None else t
+    counter = struct.pack(">Q", int(t) // interval)
+
+    digest = hmac.new(raw_seed, counter, hashlib.sha1).digest()
+    offset = digest[-1] & 0x0F
+    code = struct.unpack_from(">I", digest, offset)[0] & 0x7FFFFFFF
+    return f"{code % 1_000_000:06d}"
+
+
+def calculate_totp_codes(
+    seeds: Dict[str, bytes], for_time=None, interval=30
+) -> Dict[str, str]:
+    """Return a map of account -> 6 digits TOTP code (SHA1) for decoded seeds
+
+    Same result as pyotp.TOTP(secret).now(), but all the codes share the same
+    time, and the seeds are decoded once by the caller.
+    """
+    for_time = time.time() if for_time is None else for_time
+    return {
+        account: totp_now(seed, for_time, interval) for account, seed in seeds.items()
+    }